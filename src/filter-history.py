@@ -1,21 +1,24 @@
 """gitの特定ディレクトリ以下の履歴を別のリポジトリに切り出すスクリプト."""
-import contextlib
+import atexit
 import dataclasses
+import functools
 import logging
-import os
+import queue
 import shlex
 import shutil
 import subprocess
 import sys
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from logging import Formatter, StreamHandler
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
+from typing import TypedDict
 
 _logger = logging.getLogger(__name__)
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True, frozen=True)
 class _RunConfig:
     """スクリプト実行のための設定."""
 
@@ -25,6 +28,7 @@ class _RunConfig:
     is_public: bool
     is_archive: bool
 
+    # 互換性のために引数だけ残している. 履歴の書き換えだけでコミットを作成しないので利用しない.
     git_user_name: str | None
     git_user_email: str | None
 
@@ -35,50 +39,17 @@ class _RunConfig:
     verbose: int
 
 
-class _ScriptError(Exception):
-    # スクリプト実行のエラーを表す.
+class _RunKwargs(TypedDict):
+    """各コマンドの実行に共通する引数."""
 
-    pass
+    dry_run: bool
+    timeout_sec: int
 
 
-def _change_root_directory(
-    clone_dir: Path,  # リポジトリをクローンしたディレクトリパス
-    target_dir: Path,  # 履歴を抽出したディレクトリパス
-    dry_run: bool,
-    timeout_sec: int,
-) -> None:
-    with _working_directory(clone_dir.absolute()):
-        # 抽出したフォルダからファイルを移動するが、ルートフォルダに同盟があると移動できない
-        # そのため、一度renameして元のフォルダを削除してから、再度元の名称に変更する
-        root_folders = set([f.name for f in Path().iterdir()])
-        target_files = list([f for f in target_dir.iterdir()])
-
-        skip_folders = list()  # ルートフォルダに同盟があるためスキップするファイルリスト
-        for filepath in target_files:
-            new_name = filepath.name
-            if filepath.name in root_folders:
-                new_name += "_test"
-                skip_folders.append((new_name, filepath.name))
-            _logger.info(f"move: {filepath} to {new_name}")
-            _run_command(
-                ["git", "mv", str(filepath), str(new_name)],
-                dry_run=dry_run,
-                timeout_sec=timeout_sec,
-            )
+class _ScriptError(Exception):
+    # スクリプト実行のエラーを表す.
 
-        # ルートのフォルダは移行済みのはずなので削除
-        for old_path in root_folders:
-            if old_path == ".git":
-                continue
-            _logger.info(f"remove: {old_path}")
-            shutil.rmtree(old_path)
-        for old_filename, new_filename in skip_folders:
-            _logger.info(f"move: {old_filename} to {new_filename}")
-            _run_command(
-                ["git", "mv", str(old_filename), str(new_filename)],
-                dry_run=dry_run,
-                timeout_sec=timeout_sec,
-            )
+    pass
 
 
 def _check_tools(dry_run: bool, timeout_sec: int) -> bool:
@@ -93,29 +64,26 @@ def _check_tools(dry_run: bool, timeout_sec: int) -> bool:
     -----
     - バージョン情報が表示できなければツールが存在しない.
     - git filter-repoは <https://github.com/newren/git-filter-repo> をPATHに追加することで利用できる.
+    - 同じプロセス内ではツールごとに確認結果をキャッシュする.
     """
-
-    try:
-        _run_command(
-            ["git", "--version"],
-            dry_run=dry_run,
-            timeout_sec=timeout_sec,
-        )
-        _run_command(
-            ["git", "filter-repo", "--version"],
-            dry_run=dry_run,
-            timeout_sec=timeout_sec,
-        )
-        _run_command(
-            ["gh", "--version"],
-            dry_run=dry_run,
-            timeout_sec=timeout_sec,
+    commands = [
+        ("git", "--version"),
+        ("git", "filter-repo", "--version"),
+        ("gh", "--version"),
+    ]
+
+    # 各ツールの確認は独立しているので並列に実行し、利用できないツールはまとめて表示する
+    with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+        results = list(
+            executor.map(
+                lambda command_args: _is_tool_available(
+                    command_args, dry_run=dry_run, timeout_sec=timeout_sec
+                ),
+                commands,
+            )
         )
-    except _ScriptError as e:
-        _logger.error(f"Could not find tool: {e}")
-        return False
 
-    return True
+    return all(results)
 
 
 def _create_gh_repo_and_set_upstream(
@@ -124,7 +92,7 @@ def _create_gh_repo_and_set_upstream(
     remote_name: str,  # リモートリポジトリを設定する名称
     is_public: bool,  # Trueの場合は公開リポジトリとなる
     dry_run: bool,
-    timeout_set: int,
+    timeout_sec: int,
 ) -> None:
     _run_command(
         [
@@ -135,41 +103,75 @@ def _create_gh_repo_and_set_upstream(
             "--public" if is_public else "--private",
         ],
         dry_run=dry_run,
-        timeout_sec=timeout_set,
+        timeout_sec=timeout_sec,
+    )
+    _run_command(
+        [
+            "git",
+            "remote",
+            "add",
+            remote_name,
+            f"https://github.com/{repository_name}.git",
+        ],
+        dry_run=dry_run,
+        timeout_sec=timeout_sec,
+        cwd=git_repository,
     )
-    with _working_directory(git_repository):
-        _run_command(
-            [
-                "git",
-                "remote",
-                "add",
-                remote_name,
-                f"https://github.com/{repository_name}.git",
-            ],
-            dry_run=dry_run,
-            timeout_sec=timeout_set,
-        )
 
 
 def _filter_history(
     src_repository: str,  # 履歴を持つ元のリポジトリ名: `owner/repository-name`
     target_dir: Path,  # 履歴を抽出するフォルダパス: `test/path` -> `repository-name/test/path`
     clone_dir: Path,  # リポジトリをクローンするディレクトリパス
+    rename_files: dict[Path, Path],  # (元のファイルパス, 変更後のファイルパス)
     dry_run: bool,
     timeout_sec: int,
 ) -> None:
+    abs_clone_dir = clone_dir.absolute()
+    # filter-repoは履歴だけを利用するのでbareリポジトリとしてクローンする
+    # pushするのはデフォルトブランチだけなので、他のブランチとタグは取得しない
     _run_command(
-        ["gh", "repo", "clone", src_repository, str(clone_dir.absolute())],
+        [
+            "gh",
+            "repo",
+            "clone",
+            src_repository,
+            str(abs_clone_dir),
+            "--",
+            "--bare",
+            "--single-branch",
+            "--no-tags",
+        ],
         dry_run=dry_run,
         timeout_sec=timeout_sec,
     )
-    with _working_directory(clone_dir.absolute()):
-        _run_command(
-            # windowsの場合にバックスラッシュが適切に処理できないのでスラッシュに変更
-            ["git", "filter-repo", "--path", str(target_dir).replace("\\", "/")],
+    # windowsの場合にバックスラッシュが適切に処理できないのでスラッシュに変更
+    target_path = str(target_dir).replace("\\", "/")
+    # 抽出したフォルダ以下をリポジトリルートに移動する
+    # 抽出したフォルダ以外は残らないので、ルートフォルダと同名のファイルがあっても衝突しない
+    filter_args = ["--path", target_path, "--path-rename", f"{target_path}/:"]
+    # あらかじめ指定したファイルだけは名称変更
+    # filter-repoは全コミットを書き換え、変更後のファイルが存在するコミットでは上書きしてしまう
+    # そのため、変更後のファイルが履歴上に一度でも存在する場合は変更しない
+    for src, dst in rename_files.items():
+        dst_path = dst.as_posix()
+        if _git_path_in_history(
+            abs_clone_dir,
+            f"{target_path}/{dst_path}",
             dry_run=dry_run,
             timeout_sec=timeout_sec,
-        )
+        ):
+            _logger.warning(
+                "%s exists in history. skip renaming %s to %s.", dst, src, dst
+            )
+            continue
+        filter_args.extend(["--path-rename", f"{src.as_posix()}:{dst_path}"])
+    _run_command(
+        ["git", "filter-repo", *filter_args],
+        dry_run=dry_run,
+        timeout_sec=timeout_sec,
+        cwd=abs_clone_dir,
+    )
 
 
 def _gh_repo_archive(
@@ -184,78 +186,53 @@ def _gh_repo_archive(
     )
 
 
-def _git_commit(
-    git_directory: Path,  # コミットするディレクトリパス
-    user_name: str | None,  # コミットするユーザー名
-    user_email: str | None,  # コミットするユーザーのメールアドレス
-    message: str,  # コミット時のメッセージ
+def _git_path_in_history(
+    git_directory: Path,  # 確認するgitリポジトリのディレクトリ
+    tree_path: str,  # リポジトリ内のファイルパス: `test/path/README.md`
     dry_run: bool,
     timeout_sec: int,
-) -> None:
-    with _working_directory(git_directory.absolute()):
-        if user_name is not None:
-            _run_command(
-                ["git", "config", "--local", "user.name", user_name],
-                dry_run=dry_run,
-                timeout_sec=timeout_sec,
-            )
-        if user_email is not None:
-            _run_command(
-                ["git", "config", "--local", "user.email", user_email],
-                dry_run=dry_run,
-                timeout_sec=timeout_sec,
-            )
-        _run_command(
-            ["git", "add", "."],
-            dry_run=dry_run,
-            timeout_sec=timeout_sec,
-        )
-        _run_command(
-            ["git", "commit", "-m", message],
-            dry_run=dry_run,
-            timeout_sec=timeout_sec,
-        )
+) -> bool:  # HEADまでの履歴にファイルが存在する場合にTrueが返る. dry runの場合は常にFalse.
+    # ファイルを変更したコミットが1つでもあれば履歴上に存在する
+    # マージ済みのブランチで追加/削除された場合も検出するため、履歴を簡略化しない
+    commit = _run_command(
+        ["git", "rev-list", "-1", "--full-history", "HEAD", "--", tree_path],
+        dry_run=dry_run,
+        timeout_sec=timeout_sec,
+        cwd=git_directory,
+        capture_output=True,
+    )
+
+    return commit.strip() != ""
 
 
 def _git_push(
     git_directory: Path,  # push作業を行うgitリポジトリのディレクトリ
     remote_name: str,  # リモートリポジトリ
-    branch_name: str,  # pushするブランチ名
+    branch_name: str,  # pushするブランチ名. `HEAD`の場合はHEADが指すブランチ
     dry_run: bool,
     timeout_sec: int,
 ) -> None:
-    with _working_directory(git_directory):
-        _run_command(
-            ["git", "push", remote_name, branch_name],
-            dry_run=dry_run,
-            timeout_sec=timeout_sec,
-        )
+    _run_command(
+        ["git", "push", remote_name, branch_name],
+        dry_run=dry_run,
+        timeout_sec=timeout_sec,
+        cwd=git_directory,
+    )
 
 
-def _git_rename(
-    git_directory: Path,  # ファイル変更するgitディレクトリのパス
-    names: dict[Path, Path],  # (元のファイルパス, 変更後のファイルパス)
+@functools.lru_cache(maxsize=None)
+def _is_tool_available(
+    command_args: tuple[str, ...],  # バージョンを表示するコマンド: `("git", "--version")`
     dry_run: bool,
     timeout_sec: int,
-) -> bool:  # renameが発生した場合にTrueが返る
-    is_rename = False
-    with _working_directory(git_directory):
-        for src, dst in names.items():
-            if not src.exists():
-                _logger.info(f"{src} does not exist. skip.")
-                continue
-            if dst.exists():
-                _logger.info(f"{dst} exists. skip.")
-                continue
-
-            _run_command(
-                ["git", "mv", str(src), str(dst)],
-                dry_run=dry_run,
-                timeout_sec=timeout_sec,
-            )
-            is_rename = True
+) -> bool:  # ツールが利用できる場合にTrueが返る
+    try:
+        _run_command(list(command_args), dry_run=dry_run, timeout_sec=timeout_sec)
+    except (_ScriptError, FileNotFoundError) as e:
+        _logger.error("Could not find tool: %s", e)
+        return False
 
-    return is_rename
+    return True
 
 
 def _main() -> None:
@@ -279,78 +256,46 @@ def _main() -> None:
         # (変更前の名称, 変更後の名称)
         Path("index.md"): Path("README.md"),
     }
-
-    # 必要なツールが利用できるか先に確認する
-    is_tools = _check_tools(
+    run_kwargs = _RunKwargs(
         dry_run=config.dry_run, timeout_sec=config.default_timeout_sec
     )
+
+    # 必要なツールが利用できるか先に確認する
+    is_tools = _check_tools(**run_kwargs)
     if not is_tools:
         raise ValueError("could not find tools.")
 
     # 抽出するリポジトリをローカルに作成してから必要なデータの取り出し
+    # 元のリポジトリはルートからディレクトリを複数階層作っているはずなのでリポジトリルートに移動する
     _filter_history(
         src_repository=config.src_repository,
         target_dir=config.target_dir,
         clone_dir=repository_dir,
-        dry_run=config.dry_run,
-        timeout_sec=config.default_timeout_sec,
+        rename_files=rename_files,
+        **run_kwargs,
     )
 
-    # 元のリポジトリはルートからディレクトリを複数階層作っているはずなのでリポジトリルートにファイルを移動
-    _change_root_directory(
-        clone_dir=repository_dir,
-        target_dir=config.target_dir,
-        dry_run=config.dry_run,
-        timeout_sec=config.default_timeout_sec,
-    )
-    _git_commit(
-        git_directory=repository_dir,
-        user_name=config.git_user_name,
-        user_email=config.git_user_email,
-        message="chore: change root directory.",
-        dry_run=config.dry_run,
-        timeout_sec=config.default_timeout_sec,
-    )
-    # あらかじめ指定したファイルだけは名称変更
-    is_rename = _git_rename(
-        git_directory=repository_dir,
-        names=rename_files,
-        dry_run=config.dry_run,
-        timeout_sec=config.default_timeout_sec,
-    )
-    if is_rename:
-        _git_commit(
-            git_directory=repository_dir,
-            user_name=config.git_user_name,
-            user_email=config.git_user_email,
-            message="chore: change filenames.",
-            dry_run=config.dry_run,
-            timeout_sec=config.default_timeout_sec,
-        )
-
     # 抽出した履歴を作成するためのリポジトリを作成しpushできるように設定
     _create_gh_repo_and_set_upstream(
         git_repository=repository_dir,
         repository_name=config.dst_repository,
         remote_name="upstream",
         is_public=config.is_public,
-        dry_run=config.dry_run,
-        timeout_set=config.default_timeout_sec,
+        **run_kwargs,
     )
     _git_push(
         git_directory=repository_dir,
         remote_name="upstream",
-        branch_name="master",
-        dry_run=config.dry_run,
-        timeout_sec=config.default_timeout_sec,
+        # デフォルトブランチ名はリポジトリにより異なるので、HEADが指すデフォルトブランチを同名でpushする
+        branch_name="HEAD",
+        **run_kwargs,
     )
 
     # push後の後始末
     if config.is_archive:
         _gh_repo_archive(
             repository_name=config.dst_repository,
-            dry_run=config.dry_run,
-            timeout_sec=config.default_timeout_sec,
+            **run_kwargs,
         )
     if config.clean:
         shutil.rmtree(repository_dir)
@@ -374,9 +319,11 @@ def _parse_args() -> _RunConfig:
         "-a", "--is-archive", action="store_true", help="push先のリポジトリを最後にarchiveする."
     )
 
-    parser.add_argument("--git-user-name", default=None, help="git commitに利用するユーザー名.")
     parser.add_argument(
-        "--git-user-email", default=None, help="git commitに利用するメールアドレス."
+        "--git-user-name", default=None, help="(deprecated) 未使用. 互換性のために残している."
+    )
+    parser.add_argument(
+        "--git-user-email", default=None, help="(deprecated) 未使用. 互換性のために残している."
     )
 
     parser.add_argument(
@@ -384,7 +331,11 @@ def _parse_args() -> _RunConfig:
     )
 
     parser.add_argument(
-        "-t", "--default-timeout-sec", default=30, help="各コマンドのタイムアウト待ち時間."
+        "-t",
+        "--default-timeout-sec",
+        type=int,
+        default=30,
+        help="各コマンドのタイムアウト待ち時間.",
     )
     parser.add_argument(
         "-n", "--dry-run", action="store_true", help="コマンドを実行せず実行するコマンドを表示する."
@@ -403,22 +354,34 @@ def _run_command(
     command_args: list[str],  # 実行コマンドの配列: `["ls", "-la"]`
     dry_run: bool,  # Trueの場合はdry run実行
     timeout_sec: int,  # コマンドのタイムアウト待ち時間(sec)
-) -> None:
-    _logger.info(f"=== command: `{shlex.join(command_args)}`")
+    cwd: Path | None = None,  # コマンドを実行するディレクトリ. Noneの場合はカレントディレクトリ.
+    capture_output: bool = False,  # Trueの場合は標準出力を表示せずに戻り値として返す
+) -> str:  # capture_outputがTrueの場合は標準出力. それ以外は空文字列.
+    # shlex.joinは引数ごとにクォート処理が走るので、ログ出力しない場合は実行しない
+    if _logger.isEnabledFor(logging.INFO):
+        _logger.info("=== command: `%s`", shlex.join(command_args))
     if dry_run:
         # dry run実行のためコマンドだけ出力して何もしない
-        return
+        return ""
 
-    proc = subprocess.Popen(command_args, encoding="utf-8")
+    # 出力を取得しない場合は標準入出力は親プロセスのものをそのまま引き継ぐ
     try:
-        proc.communicate(timeout=timeout_sec)
-        if proc.returncode != 0:
-            raise _ScriptError(f"command failed with exit status {proc.returncode}")
-    except Exception:
-        proc.kill()
-        raise
+        proc = subprocess.run(
+            command_args,
+            timeout=timeout_sec,
+            check=False,
+            cwd=cwd,
+            stdout=subprocess.PIPE if capture_output else None,
+            encoding="utf-8" if capture_output else None,
+        )
+    except subprocess.TimeoutExpired as e:
+        raise _ScriptError(f"command timed out after {timeout_sec} sec") from e
+    if proc.returncode != 0:
+        raise _ScriptError(f"command failed with exit status {proc.returncode}")
     _logger.info("=== success command")
 
+    return proc.stdout if capture_output else ""
+
 
 def _setup_logger(
     filepath: Path | None,  # ログ出力するファイルパス. Noneの場合はファイル出力しない.
@@ -450,18 +413,14 @@ def _setup_logger(
         file_handler.setFormatter(
             Formatter("[%(levelname)7s] %(asctime)s (%(name)s) %(message)s")
         )
-        _logger.addHandler(file_handler)
-
-
-@contextlib.contextmanager
-def _working_directory(path: Path):
-    """Change working directory and returns to previous on exit."""
-    prev_cwd = Path.cwd()
-    os.chdir(path)
-    try:
-        yield
-    finally:
-        os.chdir(prev_cwd)
+        # ファイルへの書き込みで処理を止めないように、別スレッドで出力する
+        log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.setLevel(loglevel)
+        _logger.addHandler(queue_handler)
+        listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
 
 
 if __name__ == "__main__":